@@ -1,42 +1,133 @@
 import os
 import asyncio
-import json
+import logging # Debug output on the message path, formatted only when enabled
+import orjson # Fast JSON (de)serialization for the state file and mentions log
+import base64 # Compact file_reference encoding in the state file
 import time # For uptime calculation
+import sqlite3 # Errors raised while writing the optional session file
 from datetime import datetime, timedelta # For temporary offline mode
+from dataclasses import dataclass, replace
 import re # For better keyword matching and regex escaping
+from collections import deque # For reading the tail of the mentions log
 
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
 from telethon import TelegramClient, events
-from telethon.sessions import StringSession
-from telethon.tl.types import User, Channel, Chat, MessageMediaPhoto, MessageMediaDocument, InputPhoto, InputDocument
-from telethon.errors import ChatIdInvalidError, PeerIdInvalidError, RPCError, PhotoInvalidError, DocumentInvalidError
+from telethon.sessions import StringSession, SQLiteSession
+from telethon.tl.types import User, PeerChannel, MessageMediaPhoto, MessageMediaDocument, InputPhoto, InputDocument
+from telethon.errors import ChatIdInvalidError, PeerIdInvalidError, RPCError, PhotoInvalidError, DocumentInvalidError, FloodWaitError
+
+logger = logging.getLogger(__name__)
 
 # --- Environment Variables ---
 API_ID = int(os.getenv("API_ID"))
 API_HASH = os.getenv("API_HASH")
 SESSION = os.getenv("SESSION")
+# Optional SQLite session file; once written, restarts reuse it (and its entity cache) instead of SESSION
+SESSION_FILE = os.getenv("SESSION_FILE")
 OWNER_ID = int(os.getenv("OWNER_ID"))
 TARGET_CHAT_ID_ENV = os.getenv("TARGET_CHAT_ID") # Keep as string initially
 
 # Define storage file
 STORAGE_FILE = os.getenv("STORAGE_FILE", "bot_state.json")
+# Append-only log (one JSON object per line) of messages received while offline
+MENTIONS_LOG_FILE = os.getenv("MENTIONS_LOG_FILE", "mentions.jsonl")
+MENTIONS_LOG_MAX_ENTRIES = int(os.getenv("MENTIONS_LOG_MAX_ENTRIES", "1000")) # Older entries are trimmed
 
 # --- Global State ---
-app = FastAPI()
-client = TelegramClient(StringSession(SESSION), API_ID, API_HASH)
+app = FastAPI(default_response_class=ORJSONResponse)
+# An existing session file wins over SESSION; delete it to switch to a new session string
+if SESSION_FILE and os.path.exists(SESSION_FILE if SESSION_FILE.endswith(".session") else SESSION_FILE + ".session"):
+    print(f"Using session file {SESSION_FILE} (the SESSION environment variable is ignored while it exists).")
+    client = TelegramClient(SQLiteSession(SESSION_FILE), API_ID, API_HASH)
+else:
+    print("Using the SESSION environment variable.")
+    client = TelegramClient(StringSession(SESSION), API_ID, API_HASH)
+
+@dataclass(frozen=True, slots=True)
+class OfflineState:
+    offline: bool = False
+    message: str = "I'm currently offline. Will reply soon!"
+    until: datetime | None = None # When timed offline mode ends
 
-is_offline = False
-offline_message = "I'm currently offline. Will reply soon!"
-offline_until_timestamp = None # Stores datetime object for when offline mode ends
+# Replaced as a whole (never mutated) so readers always see a consistent offline/message/until triple
+offline_state = OfflineState()
+offline_expiry_task = None # Sleeps until offline_state.until, then switches back online
 
 # Persistence data structures
 # Use sets for dnd_chats for efficient lookups and to avoid duplicates
 dnd_chats = set()
-specific_autoreplies = {} # {chat_id: "message"}
+specific_autoreplies = {} # {chat_id (int): "message"}
+ENTITY_CACHE_TTL = 300 # Seconds a resolved chat entity is reused by the list/DND commands
+entity_cache = {} # {chat_id or username: (monotonic time resolved, entity)}
+SENDER_BOT_CACHE_MAX = 10000 # Cleared when full; entries are cheap to refetch
+sender_is_bot = {} # {sender_id: bool}, so repeat senders don't need their User fetched to be screened
+
+trigger_pattern = None # All custom command triggers compiled into one regex; rebuilt whenever custom_commands changes
+trigger_first_chars = frozenset() # Every character a trigger can start with; a message containing none of them can't match
+ignorecase_variants_cache = {} # {char: frozenset of characters re.IGNORECASE treats as equal to it}
 custom_commands = {} # {"trigger": {"type": "text", "content": "reply_message"}} or {"type": "media", "content": {"id": ..., "access_hash": ..., "file_reference": ...}, "caption": "optional_caption", "is_photo": True/False}
 is_case_sensitive_commands = False # Default to case-insensitive
 
-bot_start_time = datetime.now() # To track bot uptime
+bot_start_time = time.monotonic() # To track bot uptime; unaffected by wall-clock changes
+client_task = None # Background task running client.run_until_disconnected()
+
+mentions_log_fh = None # Opened once at startup in append mode
+mentions_log_lines = 0 # Entries currently in the log file, used to decide when to trim it
+mentions_log_lock = asyncio.Lock() # Serializes appends with trimming
+
+# Forwards to TARGET_CHAT_ID are drained by one worker so bursts don't trip Telegram's flood limits
+notify_queue = asyncio.Queue(maxsize=100) # Items are (event, sender); new ones are dropped when full
+notify_task = None # Background task running notify_worker()
+NOTIFY_MIN_INTERVAL = 3 # Seconds between notifications, keeping TARGET_CHAT_ID at or under ~20 per minute
+SAVE_STATE_DELAY = 0.5 # Seconds to coalesce state changes into one write
+state_dirty = asyncio.Event() # Set by save_state(), cleared by state_flusher() before writing
+state_flush_task = None # Background task running state_flusher()
+background_tasks = set() # Strong references to fire-and-forget tasks until they finish
+bot_started = False # Set by the first startup(); later calls return without starting anything twice
+recent_mentions = deque(maxlen=10) # In-memory tail of the mentions log, served by /getmentions
+MENTION_PREVIEW_CHARS = 200 # Per-entry text shown by /getmentions
+
+# --- Help Messages ---
+OWNER_HELP_MESSAGE = """
+Owner Commands:
+**Offline/Online Mode:**
+- `/offline [message]`: Go offline with an optional message.
+- `/offline_for <number> <unit> [message]`: Go offline for a duration (e.g., `2h`, `30m`).
+- `/online`: Go online.
+- `/getmentions`: Show the last 10 messages received while offline.
+
+**Do Not Disturb (DND):**
+- `/dnd <chat_id/username>`: Add chat to DND list (no auto-replies).
+- `/undnd <chat_id/username>`: Remove chat from DND list.
+- `/list_dnd`: List all DND chats.
+
+**Specific Auto-Replies:**
+- `/set_autoreply <chat_id/username> | <message>`: Set a custom auto-reply for a chat.
+- `/del_autoreply <chat_id/username>`: Delete a custom auto-reply.
+- `/list_autoreplies`: List all specific auto-replies.
+
+**Custom Commands:**
+- `/set_command <trigger> | <reply>`: Set a text-based custom command.
+- `/set_command_media <trigger> | [caption]`: **Reply to a photo/document** to set it as a media command.
+- `/del_command <trigger>`: Delete a custom command.
+- `/list_commands`: List all custom commands.
+- `/set_case_sensitive <on/off>`: Toggle case sensitivity for custom commands.
+
+**Utilities:**
+- `/status`: Show bot uptime and current state.
+- `/help_owner`: Show this help message.
+"""
+
+PUBLIC_HELP_MESSAGE = """
+Hi! I'm an auto-reply bot.
+
+If I'm online, I can respond to specific keywords:
+- Type `/list_commands` to see currently available custom commands.
+
+If I'm offline, I'll send an automatic reply.
+"""
 
 # --- Target Chat ID for Offline Notifications ---
 TARGET_CHAT_ID = "me" # Default to Saved Messages
@@ -47,86 +138,104 @@ if TARGET_CHAT_ID_ENV:
         print(f"Warning: TARGET_CHAT_ID environment variable '{TARGET_CHAT_ID_ENV}' is not a valid integer. Defaulting to 'me'.")
 else:
     print("Info: TARGET_CHAT_ID environment variable not set. Offline messages will be forwarded to 'me' (Saved Messages).")
+target_peer = TARGET_CHAT_ID # Replaced by the resolved InputPeer once the client has started
 
 # --- Persistence Functions ---
+def has_file_reference(media_data):
+    return "file_reference_b64" in media_data or "file_reference" in media_data
+
+
+def decode_file_reference(media_data):
+    """
+    Returns the file_reference bytes of a saved media command.
+    New saves use base64 under "file_reference_b64"; older state files stored hex under "file_reference".
+    """
+    if "file_reference_b64" in media_data:
+        return base64.b64decode(media_data["file_reference_b64"], validate=True)
+    return bytes.fromhex(media_data["file_reference"])
+
+
+def reconstruct_media(media_data, cls, trigger):
+    """
+    Rebuilds an InputPhoto or InputDocument from its saved fields, or returns None if they are missing or invalid.
+    """
+    if not ("id" in media_data and "access_hash" in media_data and has_file_reference(media_data)):
+        print(f"Warning: Missing {cls.__name__} components for '{trigger}'.")
+        return None
+    try:
+        return cls(
+            id=media_data["id"],
+            access_hash=media_data["access_hash"],
+            file_reference=decode_file_reference(media_data)
+        )
+    except (TypeError, ValueError) as e:
+        print(f"Warning: Could not reconstruct {cls.__name__} for '{trigger}' due to bad file_reference: {e}")
+        return None
+
+
 def load_state():
-    global dnd_chats, specific_autoreplies, custom_commands, is_case_sensitive_commands
+    global dnd_chats, specific_autoreplies, custom_commands, is_case_sensitive_commands, \
+           offline_state
+    # Open directly instead of checking os.path.exists first: one syscall fewer, and no race
     try:
-        if os.path.exists(STORAGE_FILE):
-            with open(STORAGE_FILE, "r") as f:
-                state = json.load(f)
-                dnd_chats = set(state.get("dnd_chats", []))
-                specific_autoreplies = state.get("specific_autoreplies", {})
-                
-                # Custom loading for custom_commands to reconstruct InputPhoto/InputDocument
-                loaded_commands = state.get("custom_commands", {})
-                reconstructed_commands = {}
-                for trigger, details in loaded_commands.items():
-                    if details.get("type") == "media" and "content" in details:
-                        media_data = details["content"]
-                        if details.get("is_photo"):
-                            if all(k in media_data for k in ["id", "access_hash", "file_reference"]):
-                                try:
-                                    # Decode file_reference from base64 if it was encoded for JSON
-                                    file_reference_bytes = bytes.fromhex(media_data["file_reference"])
-                                    reconstructed_commands[trigger] = {
-                                        "type": "media",
-                                        "content": InputPhoto(
-                                            id=media_data["id"],
-                                            access_hash=media_data["access_hash"],
-                                            file_reference=file_reference_bytes # Ensure bytes
-                                        ),
-                                        "caption": details.get("caption", ""),
-                                        "is_photo": True
-                                    }
-                                except (TypeError, ValueError) as e:
-                                    print(f"Warning: Could not reconstruct InputPhoto for '{trigger}' due to bad file_reference: {e}")
-                                    # Fallback or skip if reconstruction fails
-                                    reconstructed_commands[trigger] = {"type": "text", "content": "Error: Media asset unavailable."}
-                            else:
-                                print(f"Warning: Missing photo components for '{trigger}'.")
-                                reconstructed_commands[trigger] = {"type": "text", "content": "Error: Media asset unavailable."}
-                        else: # Assume Document
-                            if all(k in media_data for k in ["id", "access_hash", "file_reference"]):
-                                try:
-                                    file_reference_bytes = bytes.fromhex(media_data["file_reference"])
-                                    reconstructed_commands[trigger] = {
-                                        "type": "media",
-                                        "content": InputDocument(
-                                            id=media_data["id"],
-                                            access_hash=media_data["access_hash"],
-                                            file_reference=file_reference_bytes # Ensure bytes
-                                        ),
-                                        "caption": details.get("caption", ""),
-                                        "is_photo": False
-                                    }
-                                except (TypeError, ValueError) as e:
-                                    print(f"Warning: Could not reconstruct InputDocument for '{trigger}' due to bad file_reference: {e}")
-                                    reconstructed_commands[trigger] = {"type": "text", "content": "Error: Media asset unavailable."}
-                            else:
-                                print(f"Warning: Missing document components for '{trigger}'.")
-                                reconstructed_commands[trigger] = {"type": "text", "content": "Error: Media asset unavailable."}
+        with open(STORAGE_FILE, "rb") as f:
+            raw_state = f.read()
+    except FileNotFoundError:
+        raw_state = None
+        print(f"No state file found at {STORAGE_FILE}. Starting fresh.")
+    try:
+        if raw_state is not None:
+            state = orjson.loads(raw_state)
+            dnd_chats = set(state.get("dnd_chats", []))
+            # JSON object keys are always strings; key by int so lookups use event.chat_id directly
+            specific_autoreplies = {int(k): v for k, v in state.get("specific_autoreplies", {}).items()}
+            
+            # Custom loading for custom_commands to reconstruct InputPhoto/InputDocument
+            loaded_commands = state.get("custom_commands", {})
+            reconstructed_commands = {}
+            for trigger, details in loaded_commands.items():
+                if details.get("type") == "media" and "content" in details:
+                    is_photo = bool(details.get("is_photo"))
+                    media_obj = reconstruct_media(details["content"], InputPhoto if is_photo else InputDocument, trigger)
+                    if media_obj is None:
+                        reconstructed_commands[trigger] = {"type": "text", "content": "Error: Media asset unavailable."}
                     else:
-                        reconstructed_commands[trigger] = details # Keep text commands as is
-                custom_commands = reconstructed_commands
+                        reconstructed_commands[trigger] = {
+                            "type": "media",
+                            "content": media_obj,
+                            "caption": details.get("caption", ""),
+                            "is_photo": is_photo
+                        }
+                else:
+                    reconstructed_commands[trigger] = details # Keep text commands as is
+            custom_commands = reconstructed_commands
+
+            is_case_sensitive_commands = state.get("is_case_sensitive_commands", False)
 
-                is_case_sensitive_commands = state.get("is_case_sensitive_commands", False)
+            until = state.get("offline_until_timestamp")
+            offline_state = OfflineState(
+                offline=state.get("is_offline", False),
+                message=state.get("offline_message", offline_state.message),
+                until=datetime.fromisoformat(until) if until else None,
+            )
             print(f"Bot state loaded from {STORAGE_FILE}")
-        else:
-            print(f"No state file found at {STORAGE_FILE}. Starting fresh.")
-    except (json.JSONDecodeError, FileNotFoundError) as e:
+    except (orjson.JSONDecodeError, ValueError) as e:
         print(f"Error loading state: {e}. Starting fresh.")
     if not isinstance(dnd_chats, set): dnd_chats = set()
     if not isinstance(specific_autoreplies, dict): specific_autoreplies = {}
     if not isinstance(custom_commands, dict): custom_commands = {}
     if not isinstance(is_case_sensitive_commands, bool): is_case_sensitive_commands = False
+    rebuild_trigger_index()
 
 
-def save_state():
+def serialize_state():
     state = {
         "dnd_chats": list(dnd_chats),
         "specific_autoreplies": specific_autoreplies,
         "is_case_sensitive_commands": is_case_sensitive_commands,
+        "is_offline": offline_state.offline,
+        "offline_message": offline_state.message,
+        "offline_until_timestamp": offline_state.until.isoformat() if offline_state.until else None,
     }
 
     # Custom saving for custom_commands to handle InputPhoto/InputDocument
@@ -134,13 +243,13 @@ def save_state():
     for trigger, details in custom_commands.items():
         if details.get("type") == "media" and isinstance(details.get("content"), (InputPhoto, InputDocument)):
             media_obj = details["content"]
-            # Convert bytes (file_reference) to hex string for JSON serialization
+            # Convert bytes (file_reference) to base64 for JSON serialization; 4/3 the size instead of hex's 2x
             serializable_commands[trigger] = {
                 "type": "media",
                 "content": {
                     "id": media_obj.id,
                     "access_hash": media_obj.access_hash,
-                    "file_reference": media_obj.file_reference.hex() # Convert bytes to hex string
+                    "file_reference_b64": base64.b64encode(media_obj.file_reference).decode("ascii")
                 },
                 "caption": details.get("caption", ""),
                 "is_photo": isinstance(media_obj, InputPhoto)
@@ -148,15 +257,287 @@ def save_state():
         else:
             serializable_commands[trigger] = details
     state["custom_commands"] = serializable_commands
+    return orjson.dumps(state, option=orjson.OPT_NON_STR_KEYS) # int chat_id keys are written as strings
+
+
+def write_state_file(data):
+    # Write a sibling file and rename it over the old one so readers never see a partial file
+    tmp_file = STORAGE_FILE + ".tmp"
+    try:
+        with open(tmp_file, "wb") as f:
+            f.write(data)
+        os.replace(tmp_file, STORAGE_FILE)
+    except OSError:
+        # Don't leave a half-written temp file behind; the previous state file is untouched
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        raise
+
+
+def save_state():
+    """
+    Marks the state as changed. state_flusher() writes it shortly afterwards,
+    so a burst of changes costs a single write and never blocks the event loop.
+    """
+    state_dirty.set()
+
 
+async def flush_state():
+    data = serialize_state() # Snapshot on the event loop, write in a worker thread
     try:
-        with open(STORAGE_FILE, "w") as f:
-            json.dump(state, f, indent=4)
+        await asyncio.to_thread(write_state_file, data)
         print(f"Bot state saved to {STORAGE_FILE}")
     except IOError as e:
         print(f"Error saving state: {e}")
 
+
+async def state_flusher():
+    while True:
+        await state_dirty.wait()
+        await asyncio.sleep(SAVE_STATE_DELAY)
+        state_dirty.clear()
+        await flush_state()
+
+def save_session_file():
+    """
+    Copies the authorized string session into SESSION_FILE so the next start can use it.
+    """
+    # The file is only a cache; a bad or unmounted path must not stop the bot from starting
+    try:
+        file_session = SQLiteSession(SESSION_FILE)
+        try:
+            file_session.set_dc(client.session.dc_id, client.session.server_address, client.session.port)
+            file_session.auth_key = client.session.auth_key
+            file_session.save()
+            print(f"Session saved to {SESSION_FILE}")
+        finally:
+            file_session.close()
+    except (sqlite3.Error, OSError) as e:
+        print(f"Warning: Could not save session to {SESSION_FILE}: {e}. Continuing with the string session.")
+
+# --- Custom Command Matching ---
+def ignorecase_variants(chars):
+    """
+    Returns every character re.IGNORECASE treats as equal to one of chars. This is more than
+    lower() and upper(): "k" also matches the Kelvin sign, and "s" matches "ſ".
+    """
+    missing = [char for char in chars if char not in ignorecase_variants_cache]
+    if missing:
+        # Ask the regex engine itself, so the prefilter can never reject a message the pattern would match.
+        # Scanning every code point takes about a tenth of a second; it only runs when a first character is new.
+        every_char = "".join(map(chr, range(0x110000)))
+        for char in missing:
+            ignorecase_variants_cache[char] = frozenset(re.findall(re.escape(char), every_char, re.IGNORECASE))
+    return frozenset().union(*(ignorecase_variants_cache[char] for char in chars))
+
+
+def rebuild_trigger_index():
+    """
+    Compiles every trigger into a single alternation, longest first, so one scan finds them all.
+    Case-insensitive mode is handled by re.IGNORECASE, so messages are never lowercased.
+    Must be called after any change to custom_commands or is_case_sensitive_commands.
+    """
+    global trigger_pattern, trigger_first_chars
+    if not custom_commands:
+        trigger_pattern = None
+        trigger_first_chars = frozenset()
+        return
+    if is_case_sensitive_commands:
+        trigger_first_chars = frozenset(trigger[0] for trigger in custom_commands)
+    else:
+        trigger_first_chars = ignorecase_variants({trigger[0] for trigger in custom_commands})
+    alternation = "|".join(re.escape(trigger) for trigger in sorted(custom_commands, key=len, reverse=True))
+    # Zero-width lookahead so matches at every position are reported, including overlapping ones
+    flags = 0 if is_case_sensitive_commands else re.IGNORECASE
+    trigger_pattern = re.compile(r"(?=\b(" + alternation + r")\b)", flags)
+
+
+def find_custom_command(text):
+    """
+    Returns the custom_commands key of the longest trigger that appears in text as a whole word, or None.
+    """
+    if trigger_pattern is None or trigger_first_chars.isdisjoint(text):
+        return None # Cheap rejection before running the regex over the whole message
+    best = None
+    for match in trigger_pattern.finditer(text):
+        found = match.group(1)
+        if not is_case_sensitive_commands:
+            # Keys are stored lowercased, but re.IGNORECASE also folds pairs like ı/i and ſ/s that
+            # str.lower() doesn't map back, so only accept a match that lowercases to a real key
+            found = found.lower()
+            if found not in custom_commands:
+                continue
+        if best is None or len(found) > len(best):
+            best = found
+    return best
+
+# --- Background Tasks ---
+def spawn_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# --- Mentions Log Functions ---
+def compact_mentions_log():
+    """
+    Trims the mentions log to its last MENTIONS_LOG_MAX_ENTRIES lines.
+    Returns the number of lines left in the file.
+    """
+    tail = deque(maxlen=MENTIONS_LOG_MAX_ENTRIES)
+    total = 0
+    try:
+        with open(MENTIONS_LOG_FILE, "rb") as f:
+            for line in f:
+                tail.append(line)
+                total += 1
+    except FileNotFoundError:
+        return 0
+    if total <= MENTIONS_LOG_MAX_ENTRIES:
+        return total
+
+    tmp_file = MENTIONS_LOG_FILE + ".tmp"
+    try:
+        with open(tmp_file, "wb") as f:
+            f.writelines(tail)
+        os.replace(tmp_file, MENTIONS_LOG_FILE)
+    except OSError:
+        # Don't leave a half-written temp file behind; the log itself is untouched
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        raise
+    print(f"Mentions log trimmed from {total} to {len(tail)} entries.")
+    return len(tail)
+
+
+def open_mentions_log():
+    global mentions_log_fh, mentions_log_lines
+    # The log is optional; an unreadable or read-only path must not stop the bot from starting
+    try:
+        mentions_log_lines = compact_mentions_log()
+        recent_mentions.extend(read_recent_mentions(recent_mentions.maxlen))
+        # Unbuffered so every entry reaches the OS as soon as it is written
+        mentions_log_fh = open(MENTIONS_LOG_FILE, "ab", buffering=0)
+    except OSError as e:
+        mentions_log_fh = None # log_mention() skips writing while this is None
+        print(f"Warning: Could not open mentions log {MENTIONS_LOG_FILE}: {e}. Mentions won't be logged to disk.")
+
+
+def rotate_mentions_log():
+    global mentions_log_fh, mentions_log_lines
+    mentions_log_fh.close()
+    try:
+        mentions_log_lines = compact_mentions_log()
+    finally:
+        # Reopen even if compacting failed, or every later write would hit a closed file
+        mentions_log_fh = open(MENTIONS_LOG_FILE, "ab", buffering=0)
+
+
+def read_recent_mentions(limit=10):
+    try:
+        with open(MENTIONS_LOG_FILE, "rb") as f:
+            lines = deque(f, maxlen=limit) # Only the last `limit` lines are kept
+    except FileNotFoundError:
+        return []
+    mentions = []
+    for line in lines:
+        try:
+            mentions.append(orjson.loads(line))
+        except orjson.JSONDecodeError:
+            continue # Skip a partially written line
+    return mentions
+
+
+async def log_mention(event, sender):
+    """
+    Appends one entry to the mentions log without blocking the event loop.
+    The file is trimmed once it holds twice MENTIONS_LOG_MAX_ENTRIES lines.
+    """
+    global mentions_log_lines
+    if mentions_log_fh is None:
+        return
+    entry = {
+        "time": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "chat_id": event.chat_id,
+        "sender_id": event.sender_id,
+        "sender_name": getattr(sender, "first_name", None) or "Unknown",
+        "text": event.raw_text,
+    }
+    recent_mentions.append(entry)
+    try:
+        async with mentions_log_lock:
+            await asyncio.to_thread(mentions_log_fh.write, orjson.dumps(entry) + b"\n")
+            mentions_log_lines += 1
+            if mentions_log_lines > 2 * MENTIONS_LOG_MAX_ENTRIES:
+                await asyncio.to_thread(rotate_mentions_log)
+    except (IOError, ValueError) as e:
+        print(f"Error writing to mentions log: {e}")
+
+# --- Offline Notification ---
+async def call_with_flood_wait(make_request):
+    """
+    Awaits make_request(), sleeping out any FloodWaitError and retrying.
+    """
+    while True:
+        try:
+            return await make_request()
+        except FloodWaitError as e:
+            print(f"Flood wait while notifying TARGET_CHAT_ID; sleeping {e.seconds}s.")
+            await asyncio.sleep(e.seconds)
+
+
+async def notify_target_chat(event, sender):
+    """
+    Forwards a message received while offline to TARGET_CHAT_ID, followed by a note about its sender.
+    """
+    try:
+        forwarded = await call_with_flood_wait(lambda: event.forward_to(target_peer))
+        sender_name = sender.first_name or "Unknown"
+        username = f"@{sender.username}" if sender.username else "No username"
+        await call_with_flood_wait(lambda: client.send_message(
+            target_peer,
+            f"↖️ Message above was from {sender_name} ({username}) (ID: `{event.sender_id}`) while you were offline.",
+            # Thread the note onto the forwarded copy so the pair stays linked even if other messages land in between
+            reply_to=getattr(forwarded, "id", None)
+        ))
+    except Exception as e:
+        print(f"Error forwarding message or sending notification to TARGET_CHAT_ID {TARGET_CHAT_ID}: {e}")
+
+
+def enqueue_notification(event, sender):
+    try:
+        notify_queue.put_nowait((event, sender))
+    except asyncio.QueueFull:
+        print(f"Notification queue full; not forwarding message {event.id} from chat {event.chat_id}.")
+
+
+async def notify_worker():
+    while True:
+        event, sender = await notify_queue.get()
+        try:
+            await notify_target_chat(event, sender)
+        finally:
+            notify_queue.task_done()
+        await asyncio.sleep(NOTIFY_MIN_INTERVAL)
+
 # --- Helper Function to Get Chat Entity ---
+async def cached_get_entity(key):
+    """
+    client.get_entity() with results reused for ENTITY_CACHE_TTL seconds.
+    """
+    now = time.monotonic()
+    cached = entity_cache.get(key)
+    if cached and now - cached[0] < ENTITY_CACHE_TTL:
+        return cached[1]
+    entity = await client.get_entity(key)
+    entity_cache[key] = (now, entity)
+    return entity
+
+
 async def get_chat_entity_from_arg(arg, event):
     """
     Tries to resolve a chat_id or username string to a chat entity.
@@ -168,12 +549,12 @@ async def get_chat_entity_from_arg(arg, event):
     try:
         # Try to interpret as an integer ID first
         chat_id = int(arg)
-        entity = await client.get_entity(chat_id)
+        entity = await cached_get_entity(chat_id)
         return entity, chat_id, None
     except ValueError:
         # Not an integer, try as a username
         try:
-            entity = await client.get_entity(arg)
+            entity = await cached_get_entity(arg)
             resolved_id = entity.id
             return entity, resolved_id, None
         except (ValueError, ChatIdInvalidError, PeerIdInvalidError) as e:
@@ -181,467 +562,532 @@ async def get_chat_entity_from_arg(arg, event):
     except (ChatIdInvalidError, PeerIdInvalidError, RPCError) as e:
         return None, None, f"Telegram API error for '{arg}': {e}"
 
-# --- Bot Startup and Message Handler ---
-@app.on_event("startup")
-async def startup():
-    print("Loading bot state...")
-    load_state()
-    print("Starting Telegram client...")
-    await client.start()
-    print("Telegram client started.")
+# --- Owner Command Handlers ---
+# Each handler receives the event and the text after the command word.
+def entity_display_name(entity):
+    return entity.title if hasattr(entity, 'title') else entity.first_name
 
-    @client.on(events.NewMessage)
-    async def handle_message(event):
-        global is_offline, offline_message, offline_until_timestamp, \
-               dnd_chats, specific_autoreplies, custom_commands, is_case_sensitive_commands
 
-        sender = await event.get_sender()
-        sender_id = event.sender_id
-        is_owner = sender_id == OWNER_ID
-        is_bot = isinstance(sender, User) and sender.bot
-        chat_id = event.chat_id
+# number, unit, optional message; any run of whitespace (including newlines) separates them.
+# Six digits keeps even 999999 days inside datetime's range instead of raising OverflowError.
+OFFLINE_FOR_RE = re.compile(r"(\d{1,6})\s+(\S+)(?:\s+(.*))?", re.DOTALL)
+# Accepted spellings of each /offline_for unit, mapped to the timedelta keyword
+TIME_UNITS = {
+    "m": "minutes", "minute": "minutes", "minutes": "minutes",
+    "h": "hours", "hour": "hours", "hours": "hours",
+    "d": "days", "day": "days", "days": "days",
+}
 
-        message_text_for_commands = event.raw_text
-        if not is_case_sensitive_commands:
-            message_text_for_commands = message_text_for_commands.lower()
 
-        if chat_id in dnd_chats:
-            return
+async def cmd_offline_for(event, arg):
+    global offline_state
+    match = OFFLINE_FOR_RE.fullmatch(arg.strip())
+    if not match:
+        await event.reply("Invalid usage. Usage: `/offline_for <number> <unit> [message]`")
+        return
+    duration_val = int(match.group(1))
 
-        # --- Owner Commands ---
-        if is_owner:
-            cmd_text_raw = event.raw_text # Use raw text for command parsing
-            cmd_text_lower = cmd_text_raw.lower()
-
-            # --- Offline/Online commands ---
-            # IMPORTANT: Check for /offline_for first (more specific)
-            if cmd_text_lower.startswith("/offline_for "):
-                clean_cmd_text = cmd_text_raw.strip()
-
-                first_space_idx = clean_cmd_text.find(" ")
-                second_space_idx = -1
-                if first_space_idx != -1:
-                    second_space_idx = clean_cmd_text.find(" ", first_space_idx + 1)
-                
-                third_space_idx = -1
-                if second_space_idx != -1:
-                    third_space_idx = clean_cmd_text.find(" ", second_space_idx + 1)
-
-                parts = []
-                offline_message_content = ""
-
-                if third_space_idx == -1: # No third space means no custom message after unit
-                    parts = clean_cmd_text.split(" ", 2) # Only command, num, unit
-                    if len(parts) < 3: # Not enough parts for even num and unit
-                        await event.reply("Invalid usage. Usage: `/offline_for <number> <unit> [message]`")
-                        return
-                    offline_message_content = "I'm temporarily offline."
-                else: # Third space found, meaning there's a custom message
-                    parts = clean_cmd_text.split(" ", 3) # Command, num, unit, message
-                    if len(parts) < 4: # Should not happen if third_space_idx is found, but for safety
-                         await event.reply("Error parsing command. Usage: `/offline_for <number> <unit> [message]`")
-                         return
-                    offline_message_content = parts[3].strip()
-
-
-                if len(parts) >= 3:
-                    try:
-                        duration_val = int(parts[1])
-                        unit_raw = parts[2].lower()
-                        
-                        time_delta = timedelta()
-                        if unit_raw in ["minutes", "minute", "m"]:
-                            time_delta = timedelta(minutes=duration_val)
-                        elif unit_raw in ["hours", "hour", "h"]:
-                            time_delta = timedelta(hours=duration_val)
-                        elif unit_raw in ["days", "day", "d"]:
-                            time_delta = timedelta(days=duration_val)
-                        else:
-                            await event.reply("Invalid time unit. Use: `m` (minutes), `h` (hours), `d` (days).")
-                            return
-
-                        offline_until_timestamp = datetime.now() + time_delta
-                        is_offline = True
-                        await event.reply(f"Offline mode enabled until {offline_until_timestamp.strftime('%Y-%m-%d %H:%M:%S')}.\nMessage: {offline_message_content}")
-                        save_state()
-                        return
-                    except ValueError:
-                        await event.reply("Invalid duration format. Usage: `/offline_for <number> <unit> [message]`")
-                        return
-                else: # Fallback if initial parsing was really off, or if only "/offline_for" was sent
-                    await event.reply("Invalid usage. Usage: `/offline_for <number> <unit> [message]`")
-                return
+    unit = TIME_UNITS.get(match.group(2).lower())
+    if unit is None:
+        await event.reply("Invalid time unit. Use: `m` (minutes), `h` (hours), `d` (days).")
+        return
+    time_delta = timedelta(**{unit: duration_val})
 
-            # THEN check for /offline (less specific)
-            elif cmd_text_lower.startswith("/offline"):
-                # Ensure it's exactly "/offline" or "/offline " to avoid matching "/offline_for" or similar
-                if cmd_text_lower == "/offline" or cmd_text_lower.startswith("/offline "):
-                    parts = cmd_text_raw.split(" ", 1) # Splits into ["/offline", "message"]
-                    offline_message = parts[1] if len(parts) > 1 else "I'm currently offline."
-                    is_offline = True
-                    offline_until_timestamp = None
-                    await event.reply(f"Offline mode enabled.\nMessage: {offline_message}")
-                    save_state()
-                    return
-            
-            elif cmd_text_lower.startswith("/online"):
-                is_offline = False
-                offline_until_timestamp = None
-                await event.reply("Online mode enabled. You're now online.")
-                save_state()
-                return
+    offline_message_content = match.group(3) or ""
+    offline_state = OfflineState(
+        offline=True,
+        message=offline_message_content or "I'm temporarily offline.",
+        until=datetime.now() + time_delta,
+    )
+    schedule_offline_expiry()
+    await event.reply(f"Offline mode enabled until {offline_state.until.strftime('%Y-%m-%d %H:%M:%S')}.\nMessage: {offline_state.message}")
+    return True
 
-            # --- DND Commands ---
-            elif cmd_text_lower.startswith("/dnd "):
-                arg = cmd_text_raw[len("/dnd "):].strip()
-                entity, resolved_id, error = await get_chat_entity_from_arg(arg, event)
-                if entity:
-                    dnd_chats.add(resolved_id)
-                    await event.reply(f"Added {entity.title if hasattr(entity, 'title') else entity.first_name} (ID: `{resolved_id}`) to DND list.")
-                    save_state()
-                else:
-                    await event.reply(f"Error adding to DND: {error}")
-                return
-            elif cmd_text_lower.startswith("/undnd "):
-                arg = cmd_text_raw[len("/undnd "):].strip()
-                entity, resolved_id, error = await get_chat_entity_from_arg(arg, event)
-                if entity:
-                    if resolved_id in dnd_chats:
-                        dnd_chats.remove(resolved_id)
-                        await event.reply(f"Removed {entity.title if hasattr(entity, 'title') else entity.first_name} (ID: `{resolved_id}`) from DND list.")
-                        save_state()
-                    else:
-                        await event.reply(f"Chat {entity.title if hasattr(entity, 'title') else entity.first_name} (ID: `{resolved_id}`) was not in DND list.")
-                else:
-                    await event.reply(f"Error removing from DND: {error}")
-                return
-            elif cmd_text_lower == "/list_dnd":
-                if dnd_chats:
-                    response = "DND Chats:\n"
-                    for chat_id_dnd in dnd_chats:
-                        try:
-                            entity = await client.get_entity(chat_id_dnd)
-                            name = entity.title if hasattr(entity, 'title') else entity.first_name
-                            response += f"- `{name}` (ID: `{chat_id_dnd}`)\n"
-                        except (ChatIdInvalidError, PeerIdInvalidError, RPCError):
-                            response += f"- Unknown Chat (ID: `{chat_id_dnd}` - possibly left/deleted)\n"
-                    await event.reply(response)
-                else:
-                    await event.reply("No chats currently in DND mode.")
-                return
 
-            # --- Specific Auto-reply Commands ---
-            elif cmd_text_lower.startswith("/set_autoreply "):
-                parts = cmd_text_raw[len("/set_autoreply "):].split("|", 1)
-                if len(parts) == 2:
-                    arg = parts[0].strip()
-                    message = parts[1].strip()
-                    entity, resolved_id, error = await get_chat_entity_from_arg(arg, event)
-                    if entity and message:
-                        specific_autoreplies[str(resolved_id)] = message
-                        await event.reply(f"Specific auto-reply set for {entity.title if hasattr(entity, 'title') else entity.first_name} (ID: `{resolved_id}`):\n`{message}`")
-                        save_state()
-                    else:
-                        await event.reply(f"Error setting auto-reply: {error or 'Message cannot be empty.'}")
-                else:
-                    await event.reply("Invalid format. Usage: `/set_autoreply <chat_id/username> | <message>`")
-                return
-            elif cmd_text_lower.startswith("/del_autoreply "):
-                arg = cmd_text_raw[len("/del_autoreply "):].strip()
-                entity, resolved_id, error = await get_chat_entity_from_arg(arg, event)
-                if entity:
-                    if str(resolved_id) in specific_autoreplies:
-                        del specific_autoreplies[str(resolved_id)]
-                        await event.reply(f"Specific auto-reply for {entity.title if hasattr(entity, 'title') else entity.first_name} (ID: `{resolved_id}`) deleted.")
-                        save_state()
-                    else:
-                        await event.reply(f"No specific auto-reply found for {entity.title if hasattr(entity, 'title') else entity.first_name} (ID: `{resolved_id}`).")
-                else:
-                    await event.reply(f"Error deleting auto-reply: {error}")
-                return
-            elif cmd_text_lower == "/list_autoreplies":
-                if specific_autoreplies:
-                    response = "Specific Auto-replies:\n"
-                    for chat_id_str, msg in specific_autoreplies.items():
-                        try:
-                            entity = await client.get_entity(int(chat_id_str))
-                            name = entity.title if hasattr(entity, 'title') else entity.first_name
-                            response += f"- `{name}` (ID: `{chat_id_str}`): `{msg}`\n"
-                        except (ChatIdInvalidError, PeerIdInvalidError, RPCError):
-                            response += f"- Unknown Chat (ID: `{chat_id_str}` - possibly left/deleted): `{msg}`\n"
-                    await event.reply(response)
-                else:
-                    await event.reply("No specific auto-replies set.")
-                return
+async def cmd_offline(event, arg):
+    global offline_state
+    offline_state = OfflineState(offline=True, message=arg or "I'm currently offline.")
+    schedule_offline_expiry()
+    await event.reply(f"Offline mode enabled.\nMessage: {offline_state.message}")
+    return True
 
-            # --- Custom Command Management ---
-            elif cmd_text_lower.startswith("/set_command "):
-                parts = cmd_text_raw[len("/set_command "):].split("|", 1)
-                if len(parts) == 2:
-                    trigger = parts[0].strip()
-                    reply = parts[1].strip()
-                    if trigger and reply:
-                        key_trigger = trigger if is_case_sensitive_commands else trigger.lower()
-                        custom_commands[key_trigger] = {"type": "text", "content": reply}
-                        await event.reply(f"Custom text command set!\nTrigger: `{trigger}`\nReply: `{reply}`")
-                        save_state()
-                    else:
-                        await event.reply("Invalid format. Trigger and reply cannot be empty. Usage: `/set_command trigger | reply`")
-                else:
-                    await event.reply("Invalid format. Usage: `/set_command trigger | reply`")
-                return
 
-            elif cmd_text_lower.startswith("/set_command_media "):
-                if event.is_reply:
-                    replied_msg = await event.get_reply_message()
-                    if replied_msg and replied_msg.media:
-                        media_object = None
-                        is_photo_media = False
-                        
-                        if isinstance(replied_msg.media, MessageMediaPhoto) and replied_msg.media.photo:
-                            media_object = replied_msg.media.photo
-                            is_photo_media = True
-                        elif isinstance(replied_msg.media, MessageMediaDocument) and replied_msg.media.document:
-                            media_object = replied_msg.media.document
-                            is_photo_media = False
-                        
-                        if media_object:
-                            parts = cmd_text_raw[len("/set_command_media "):].split("|", 1)
-                            if len(parts) >= 1:
-                                trigger = parts[0].strip()
-                                caption = parts[1].strip() if len(parts) == 2 else ""
-
-                                if trigger:
-                                    key_trigger = trigger if is_case_sensitive_commands else trigger.lower()
-                                    
-                                    custom_commands[key_trigger] = {
-                                        "type": "media",
-                                        "content": {
-                                            "id": media_object.id,
-                                            "access_hash": media_object.access_hash,
-                                            "file_reference": media_object.file_reference.hex()
-                                        },
-                                        "caption": caption,
-                                        "is_photo": is_photo_media
-                                    }
-                                    await event.reply(f"Custom media command set!\nTrigger: `{trigger}`\nMedia Type: {'Photo' if is_photo_media else 'Document'}\nCaption: `{caption}`")
-                                    save_state()
-                                else:
-                                    await event.reply("Invalid format. Trigger cannot be empty. Usage: `/set_command_media trigger | [caption]` (reply to media)")
-                            else:
-                                await event.reply("Invalid format. Usage: `/set_command_media trigger | [caption]` (reply to media)")
-                        else:
-                            await event.reply("The replied message does not contain a usable photo or document media.")
-                    else:
-                        await event.reply("You must reply to a photo or document message to use this command.")
-                else:
-                    await event.reply("This command must be a reply to the media message you want to set as a response.")
-                return
+async def cmd_online(event, arg):
+    global offline_state
+    offline_state = replace(offline_state, offline=False, until=None)
+    schedule_offline_expiry()
+    await event.reply("Online mode enabled. You're now online.")
+    return True
 
-            elif cmd_text_lower.startswith("/del_command "):
-                trigger_to_delete = cmd_text_raw[len("/del_command "):].strip()
-                key_trigger = trigger_to_delete if is_case_sensitive_commands else trigger_to_delete.lower()
-                
-                if key_trigger in custom_commands:
-                    del custom_commands[key_trigger]
-                    await event.reply(f"Custom command `{trigger_to_delete}` deleted.")
-                    save_state()
-                else:
-                    await event.reply(f"Custom command `{trigger_to_delete}` not found.")
-                return
 
-            elif cmd_text_lower == "/list_commands":
-                if custom_commands:
-                    response = "Current Custom Commands:\n"
-                    for trigger, details in custom_commands.items():
-                        cmd_type = details.get("type", "text")
-                        if cmd_type == "text":
-                            content = details.get("content", "N/A")
-                            response += f"`{trigger}` -> `{content}` (Text)\n"
-                        elif cmd_type == "media":
-                            media_content_repr = "Media Object (reconstructable)" if isinstance(details.get("content"), (InputPhoto, InputDocument)) else "Media (broken/N/A)"
-                            caption = details.get("caption", "")
-                            response += f"`{trigger}` -> {media_content_repr} (Caption: `{caption}`) (Media)\n"
-                    await event.reply(response)
-                else:
-                    await event.reply("No custom commands set yet.")
-                return
+def mention_preview(text):
+    # Ten full messages could exceed Telegram's 4096-character limit and make the reply fail
+    if len(text) > MENTION_PREVIEW_CHARS:
+        return text[:MENTION_PREVIEW_CHARS] + "…"
+    return text
 
-            elif cmd_text_lower.startswith("/set_case_sensitive "):
-                arg = cmd_text_lower[len("/set_case_sensitive "):].strip()
-                if arg == "on":
-                    is_case_sensitive_commands = True
-                    await event.reply("Custom commands are now case-sensitive.")
-                elif arg == "off":
-                    is_case_sensitive_commands = False
-                    await event.reply("Custom commands are now case-insensitive.")
-                    new_commands = {}
-                    for trigger, details in custom_commands.items():
-                        new_commands[trigger.lower()] = details
-                    custom_commands.clear()
-                    custom_commands.update(new_commands)
-                else:
-                    await event.reply("Invalid argument. Use `/set_case_sensitive on` or `/set_case_sensitive off`.")
-                save_state()
-                return
 
-            # --- General Utility Commands for Owner ---
-            elif cmd_text_lower == "/status":
-                uptime_seconds = (datetime.now() - bot_start_time).total_seconds()
-                days, remainder = divmod(uptime_seconds, 86400)
-                hours, remainder = divmod(remainder, 3600)
-                minutes, seconds = divmod(remainder, 60)
-                
-                status_msg = f"Bot Status: {'Offline' if is_offline else 'Online'}\n"
-                if is_offline and offline_until_timestamp:
-                    status_msg += f"Offline until: {offline_until_timestamp.strftime('%Y-%m-%d %H:%M:%S')}\n"
-                status_msg += f"Uptime: {int(days)}d {int(hours)}h {int(minutes)}m {int(seconds)}s\n"
-                status_msg += f"DND Chats: {len(dnd_chats)}\n"
-                status_msg += f"Specific Auto-replies: {len(specific_autoreplies)}\n"
-                status_msg += f"Custom Commands: {len(custom_commands)} (Case-sensitive: {is_case_sensitive_commands})\n"
-                await event.reply(status_msg)
-                return
+async def cmd_getmentions(event, arg):
+    if recent_mentions:
+        entries = "".join(
+            "- %s | %s (ID: `%s`) in `%s`:\n  %s\n" % (
+                entry.get("time"), entry.get("sender_name"), entry.get("sender_id"), entry.get("chat_id"),
+                mention_preview(entry.get("text") or "")
+            )
+            for entry in recent_mentions
+        )
+        await event.reply(f"Last {len(recent_mentions)} logged mentions/messages:\n{entries}")
+    else:
+        await event.reply("No mentions logged yet.")
 
-            elif cmd_text_lower == "/help_owner":
-                help_message = """
-Owner Commands:
-**Offline/Online Mode:**
-- `/offline [message]`: Go offline with an optional message.
-- `/offline_for <number> <unit> [message]`: Go offline for a duration (e.g., `2h`, `30m`).
-- `/online`: Go online.
 
-**Do Not Disturb (DND):**
-- `/dnd <chat_id/username>`: Add chat to DND list (no auto-replies).
-- `/undnd <chat_id/username>`: Remove chat from DND list.
-- `/list_dnd`: List all DND chats.
+async def cmd_dnd(event, arg):
+    entity, resolved_id, error = await get_chat_entity_from_arg(arg.strip(), event)
+    if entity:
+        dnd_chats.add(resolved_id)
+        await event.reply(f"Added {entity_display_name(entity)} (ID: `{resolved_id}`) to DND list.")
+        return True
+    else:
+        await event.reply(f"Error adding to DND: {error}")
 
-**Specific Auto-Replies:**
-- `/set_autoreply <chat_id/username> | <message>`: Set a custom auto-reply for a chat.
-- `/del_autoreply <chat_id/username>`: Delete a custom auto-reply.
-- `/list_autoreplies`: List all specific auto-replies.
 
-**Custom Commands:**
-- `/set_command <trigger> | <reply>`: Set a text-based custom command.
-- `/set_command_media <trigger> | [caption]`: **Reply to a photo/document** to set it as a media command.
-- `/del_command <trigger>`: Delete a custom command.
-- `/list_commands`: List all custom commands.
-- `/set_case_sensitive <on/off>`: Toggle case sensitivity for custom commands.
+async def cmd_undnd(event, arg):
+    entity, resolved_id, error = await get_chat_entity_from_arg(arg.strip(), event)
+    if entity:
+        if resolved_id in dnd_chats:
+            dnd_chats.remove(resolved_id)
+            entity_cache.pop(resolved_id, None)
+            await event.reply(f"Removed {entity_display_name(entity)} (ID: `{resolved_id}`) from DND list.")
+            return True
+        else:
+            await event.reply(f"Chat {entity_display_name(entity)} (ID: `{resolved_id}`) was not in DND list.")
+    else:
+        await event.reply(f"Error removing from DND: {error}")
 
-**Utilities:**
-- `/status`: Show bot uptime and current state.
-- `/help_owner`: Show this help message.
-"""
-                await event.reply(help_message)
-                return
 
-        # --- END Owner Commands ---
-
-        # --- Check Temporary Offline Mode expiration ---
-        if is_offline and offline_until_timestamp and datetime.now() >= offline_until_timestamp:
-            print("Timed offline mode expired. Switching to online.")
-            is_offline = False
-            offline_until_timestamp = None
-            try:
-                await client.send_message(OWNER_ID, "Timed offline mode has expired. I am now online.")
-            except Exception as e:
-                print(f"Could not send online notification to owner: {e}")
-            save_state()
-
-        # --- Auto-reply logic (for non-owner, and when online/offline conditions met) ---
-        is_private_or_mentioned = event.is_private or event.mentioned
-        
-        current_auto_reply_message = None
-        if str(chat_id) in specific_autoreplies:
-            current_auto_reply_message = specific_autoreplies[str(chat_id)]
-        elif is_offline:
-            current_auto_reply_message = offline_message
-
-        if is_offline and is_private_or_mentioned and not is_owner and not is_bot:
-            if current_auto_reply_message:
-                print(f"DEBUG: Replying with offline message to {sender.first_name} (ID: {sender_id}) in chat {chat_id}")
-                await event.reply(current_auto_reply_message)
-                
+async def cmd_list_dnd(event, arg):
+    if dnd_chats:
+        lines = ["DND Chats:"]
+        chat_ids = list(dnd_chats)
+        # Resolve all chats concurrently; failures come back as exceptions instead of raising
+        entities = await asyncio.gather(*(cached_get_entity(chat_id_dnd) for chat_id_dnd in chat_ids), return_exceptions=True)
+        for chat_id_dnd, entity in zip(chat_ids, entities):
+            if isinstance(entity, Exception):
+                lines.append(f"- Unknown Chat (ID: `{chat_id_dnd}` - possibly left/deleted)")
+            else:
+                lines.append(f"- `{entity_display_name(entity)}` (ID: `{chat_id_dnd}`)")
+        await event.reply("\n".join(lines))
+    else:
+        await event.reply("No chats currently in DND mode.")
+
+
+async def cmd_set_autoreply(event, arg):
+    parts = arg.split("|", 1)
+    if len(parts) == 2:
+        target = parts[0].strip()
+        message = parts[1].strip()
+        entity, resolved_id, error = await get_chat_entity_from_arg(target, event)
+        if entity and message:
+            specific_autoreplies[resolved_id] = message
+            await event.reply(f"Specific auto-reply set for {entity_display_name(entity)} (ID: `{resolved_id}`):\n`{message}`")
+            return True
+        else:
+            await event.reply(f"Error setting auto-reply: {error or 'Message cannot be empty.'}")
+    else:
+        await event.reply("Invalid format. Usage: `/set_autoreply <chat_id/username> | <message>`")
+
+
+async def cmd_del_autoreply(event, arg):
+    entity, resolved_id, error = await get_chat_entity_from_arg(arg.strip(), event)
+    if entity:
+        if resolved_id in specific_autoreplies:
+            del specific_autoreplies[resolved_id]
+            await event.reply(f"Specific auto-reply for {entity_display_name(entity)} (ID: `{resolved_id}`) deleted.")
+            return True
+        else:
+            await event.reply(f"No specific auto-reply found for {entity_display_name(entity)} (ID: `{resolved_id}`).")
+    else:
+        await event.reply(f"Error deleting auto-reply: {error}")
+
+
+async def cmd_list_autoreplies(event, arg):
+    if specific_autoreplies:
+        lines = ["Specific Auto-replies:"]
+        autoreplies = list(specific_autoreplies.items())
+        entities = await asyncio.gather(*(cached_get_entity(chat_id_ar) for chat_id_ar, _ in autoreplies), return_exceptions=True)
+        for (chat_id_ar, msg), entity in zip(autoreplies, entities):
+            if isinstance(entity, Exception):
+                lines.append(f"- Unknown Chat (ID: `{chat_id_ar}` - possibly left/deleted): `{msg}`")
+            else:
+                lines.append(f"- `{entity_display_name(entity)}` (ID: `{chat_id_ar}`): `{msg}`")
+        await event.reply("\n".join(lines))
+    else:
+        await event.reply("No specific auto-replies set.")
+
+
+async def cmd_set_command(event, arg):
+    parts = arg.split("|", 1)
+    if len(parts) == 2:
+        trigger = parts[0].strip()
+        reply = parts[1].strip()
+        if trigger and reply:
+            key_trigger = trigger if is_case_sensitive_commands else trigger.lower()
+            custom_commands[key_trigger] = {"type": "text", "content": reply}
+            rebuild_trigger_index()
+            await event.reply(f"Custom text command set!\nTrigger: `{trigger}`\nReply: `{reply}`")
+            return True
+        else:
+            await event.reply("Invalid format. Trigger and reply cannot be empty. Usage: `/set_command trigger | reply`")
+    else:
+        await event.reply("Invalid format. Usage: `/set_command trigger | reply`")
+
+
+async def cmd_set_command_media(event, arg):
+    if not event.is_reply:
+        await event.reply("This command must be a reply to the media message you want to set as a response.")
+        return
+    replied_msg = await event.get_reply_message()
+    if not (replied_msg and replied_msg.media):
+        await event.reply("You must reply to a photo or document message to use this command.")
+        return
+
+    media_object = None
+    is_photo_media = False
+    if isinstance(replied_msg.media, MessageMediaPhoto) and replied_msg.media.photo:
+        media_object = replied_msg.media.photo
+        is_photo_media = True
+    elif isinstance(replied_msg.media, MessageMediaDocument) and replied_msg.media.document:
+        media_object = replied_msg.media.document
+        is_photo_media = False
+    if not media_object:
+        await event.reply("The replied message does not contain a usable photo or document media.")
+        return
+
+    parts = arg.split("|", 1)
+    trigger = parts[0].strip()
+    caption = parts[1].strip() if len(parts) == 2 else ""
+    if not trigger:
+        await event.reply("Invalid format. Trigger cannot be empty. Usage: `/set_command_media trigger | [caption]` (reply to media)")
+        return
+
+    key_trigger = trigger if is_case_sensitive_commands else trigger.lower()
+    # Store the Input* form send_file takes directly, the same shape load_state() rebuilds from the state file
+    input_cls = InputPhoto if is_photo_media else InputDocument
+    custom_commands[key_trigger] = {
+        "type": "media",
+        "content": input_cls(
+            id=media_object.id,
+            access_hash=media_object.access_hash,
+            file_reference=media_object.file_reference
+        ),
+        "caption": caption,
+        "is_photo": is_photo_media
+    }
+    rebuild_trigger_index()
+    await event.reply(f"Custom media command set!\nTrigger: `{trigger}`\nMedia Type: {'Photo' if is_photo_media else 'Document'}\nCaption: `{caption}`")
+    return True
+
+
+async def cmd_del_command(event, arg):
+    trigger_to_delete = arg.strip()
+    key_trigger = trigger_to_delete if is_case_sensitive_commands else trigger_to_delete.lower()
+    if key_trigger in custom_commands:
+        del custom_commands[key_trigger]
+        rebuild_trigger_index()
+        await event.reply(f"Custom command `{trigger_to_delete}` deleted.")
+        return True
+    else:
+        await event.reply(f"Custom command `{trigger_to_delete}` not found.")
+
+
+async def cmd_list_commands(event, arg):
+    if custom_commands:
+        lines = ["Current Custom Commands:"]
+        for trigger, details in custom_commands.items():
+            cmd_type = details.get("type", "text")
+            if cmd_type == "text":
+                content = details.get("content", "N/A")
+                lines.append(f"`{trigger}` -> `{content}` (Text)")
+            elif cmd_type == "media":
+                media_content_repr = "Media Object (reconstructable)" if isinstance(details.get("content"), (InputPhoto, InputDocument)) else "Media (broken/N/A)"
+                caption = details.get("caption", "")
+                lines.append(f"`{trigger}` -> {media_content_repr} (Caption: `{caption}`) (Media)")
+        await event.reply("\n".join(lines))
+    else:
+        await event.reply("No custom commands set yet.")
+
+
+async def cmd_set_case_sensitive(event, arg):
+    global is_case_sensitive_commands
+    arg = arg.strip().lower()
+    if arg == "on":
+        is_case_sensitive_commands = True
+        rebuild_trigger_index()
+        await event.reply("Custom commands are now case-sensitive.")
+    elif arg == "off":
+        is_case_sensitive_commands = False
+        await event.reply("Custom commands are now case-insensitive.")
+        # Re-key in place so every reference to custom_commands sees the lowercased triggers
+        items = list(custom_commands.items())
+        custom_commands.clear()
+        custom_commands.update((trigger.lower(), details) for trigger, details in items)
+        rebuild_trigger_index()
+    else:
+        await event.reply("Invalid argument. Use `/set_case_sensitive on` or `/set_case_sensitive off`.")
+        return
+    return True
+
+
+async def cmd_status(event, arg):
+    uptime_seconds = int(time.monotonic() - bot_start_time)
+    days, remainder = divmod(uptime_seconds, 86400)
+    hours, remainder = divmod(remainder, 3600)
+    minutes, seconds = divmod(remainder, 60)
+
+    state = offline_state
+    status_msg = f"Bot Status: {'Offline' if state.offline else 'Online'}\n"
+    if state.offline and state.until:
+        status_msg += f"Offline until: {state.until.strftime('%Y-%m-%d %H:%M:%S')}\n"
+    status_msg += f"Uptime: {days}d {hours}h {minutes}m {seconds}s\n"
+    status_msg += f"DND Chats: {len(dnd_chats)}\n"
+    status_msg += f"Specific Auto-replies: {len(specific_autoreplies)}\n"
+    status_msg += f"Custom Commands: {len(custom_commands)} (Case-sensitive: {is_case_sensitive_commands})\n"
+    await event.reply(status_msg)
+
+
+async def cmd_help_owner(event, arg):
+    await event.reply(OWNER_HELP_MESSAGE)
+
+
+# Owner commands keyed by their (lowercased) command word.
+# Handlers return True when they changed persisted state; the dispatcher then saves once.
+OWNER_COMMANDS = {
+    "/offline_for": cmd_offline_for,
+    "/offline": cmd_offline,
+    "/online": cmd_online,
+    "/getmentions": cmd_getmentions,
+    "/dnd": cmd_dnd,
+    "/undnd": cmd_undnd,
+    "/list_dnd": cmd_list_dnd,
+    "/set_autoreply": cmd_set_autoreply,
+    "/del_autoreply": cmd_del_autoreply,
+    "/list_autoreplies": cmd_list_autoreplies,
+    "/set_command": cmd_set_command,
+    "/set_command_media": cmd_set_command_media,
+    "/del_command": cmd_del_command,
+    "/list_commands": cmd_list_commands,
+    "/set_case_sensitive": cmd_set_case_sensitive,
+    "/status": cmd_status,
+    "/help_owner": cmd_help_owner,
+}
+
+# --- Temporary Offline Mode ---
+def schedule_offline_expiry():
+    """
+    Re-arms the one-shot task that ends timed offline mode. Must be called whenever offline_state is replaced.
+    """
+    global offline_expiry_task
+    if offline_expiry_task:
+        offline_expiry_task.cancel()
+        offline_expiry_task = None
+    if offline_state.offline and offline_state.until:
+        delay = (offline_state.until - datetime.now()).total_seconds()
+        offline_expiry_task = asyncio.create_task(expire_timed_offline(max(delay, 0)))
+
+
+async def expire_timed_offline(delay):
+    global offline_state, offline_expiry_task
+    await asyncio.sleep(delay)
+    offline_expiry_task = None
+    print("Timed offline mode expired. Switching to online.")
+    offline_state = replace(offline_state, offline=False, until=None)
+    save_state()
+    try:
+        await client.send_message(OWNER_ID, "Timed offline mode has expired. I am now online.")
+    except Exception as e:
+        print(f"Could not send online notification to owner: {e}")
+
+# --- Telegram Message Handlers ---
+async def handle_owner_message(event):
+    if event.chat_id in dnd_chats:
+        return
+
+    command, _, arg = event.raw_text.partition(" ")
+    command_handler = OWNER_COMMANDS.get(command.lower())
+    if command_handler and await command_handler(event, arg):
+        save_state()
+
+
+async def handle_message(event):
+    sender_id = event.sender_id
+    chat_id = event.chat_id
+
+    if chat_id in dnd_chats:
+        return
+
+    # Channel posts and anonymous group admins are sent as a channel, which is never a person to answer.
+    # from_id is on the update itself, so this needs no get_sender() fetch.
+    if isinstance(event.message.from_id, PeerChannel) or (event.is_channel and not event.is_group):
+        return
+
+    # Snapshot once so /offline or /online arriving mid-handler can't mix old and new values
+    state = offline_state
+
+    # Cheap checks before any await: auto-replies and custom commands need a DM or a mention,
+    # and while online without custom commands only the public /help can reply
+    is_private_or_mentioned = event.is_private or event.mentioned
+    is_help = len(event.raw_text) == 5 and event.raw_text.lower() == "/help" # Only lowercase when it could be a match
+    if not is_help and (not is_private_or_mentioned or (not state.offline and not custom_commands)):
+        return
+
+    # A user's bot flag never changes, so only the first message from each sender may need a fetch
+    is_bot = sender_is_bot.get(sender_id)
+    if is_bot is None:
+        # event.sender is already populated when the update carried the user; only fetch when missing
+        sender = event.sender or await event.get_sender()
+        is_bot = isinstance(sender, User) and sender.bot
+        if len(sender_is_bot) >= SENDER_BOT_CACHE_MAX:
+            sender_is_bot.clear()
+        sender_is_bot[sender_id] = is_bot
+
+    # --- Auto-reply logic (for non-owner, and when online/offline conditions met) ---
+    current_auto_reply_message = None
+    if chat_id in specific_autoreplies:
+        current_auto_reply_message = specific_autoreplies[chat_id]
+    elif state.offline:
+        current_auto_reply_message = state.message
+
+    if state.offline and is_private_or_mentioned and not is_bot:
+        if current_auto_reply_message:
+            # The forward note and mentions log show the sender's name, so the User is needed here
+            sender = event.sender or await event.get_sender()
+            logger.debug("Replying with offline message to %s (ID: %s) in chat %s", sender.first_name, sender_id, chat_id)
+            # Logging and forwarding run in the background; the handler only waits for the reply
+            enqueue_notification(event, sender)
+            spawn_background(log_mention(event, sender))
+            await event.reply(current_auto_reply_message)
+            return
+
+    # --- Custom Command execution ---
+    if custom_commands and not state.offline and not is_bot and is_private_or_mentioned:
+        trigger_key = find_custom_command(event.raw_text)
+        command_details = custom_commands.get(trigger_key) if trigger_key is not None else None
+        if command_details is not None:
+            cmd_type = command_details.get("type", "text")
+            content_to_send = command_details.get("content")
+
+            if cmd_type == "text":
+                logger.debug("Found custom text command trigger '%s'. Replying to %s.", trigger_key, sender_id)
+                await event.reply(content_to_send)
+                return
+            elif cmd_type == "media" and content_to_send:
+                caption = command_details.get("caption", "")
+                logger.debug("Found custom media command trigger '%s'. Replying with media to %s.", trigger_key, sender_id)
                 try:
-                    await event.forward_to(TARGET_CHAT_ID)
-                    sender_name = sender.first_name or "Unknown"
-                    username = f"@{sender.username}" if sender.username else "No username"
-                    await client.send_message(
-                        TARGET_CHAT_ID,
-                        f"↖️ Message above was from {sender_name} ({username}) (ID: `{sender_id}`) while you were offline."
-                    )
+                    await client.send_file(event.chat_id, content_to_send, caption=caption, reply_to=event.id)
+                    return
+                except (PhotoInvalidError, DocumentInvalidError, RPCError) as e:
+                    print(f"Error sending media for command '{trigger_key}' (ID/Hash/Ref invalid?): {e}")
+                    await event.reply(f"Sorry, I had an issue sending the media for that command ({e}). The media might be expired or invalid. Please notify my owner.")
+                    return
                 except Exception as e:
-                    print(f"Error forwarding message or sending notification to TARGET_CHAT_ID {TARGET_CHAT_ID}: {e}")
-                return
+                    print(f"General error sending media for command '{trigger_key}': {e}")
+                    await event.reply(f"Sorry, a general error occurred while sending the media for that command ({e}). Please notify my owner.")
+                    return
 
-        # --- Custom Command execution ---
-        if not is_offline and not is_owner and not is_bot and is_private_or_mentioned:
-            sorted_triggers = sorted(custom_commands.keys(), key=len, reverse=True)
-            
-            for trigger_key in sorted_triggers:
-                if re.search(r'\b' + re.escape(trigger_key) + r'\b', message_text_for_commands):
-                    command_details = custom_commands[trigger_key]
-                    cmd_type = command_details.get("type", "text")
-                    content_to_send = command_details.get("content")
-
-                    if cmd_type == "text":
-                        print(f"DEBUG: Found custom text command trigger '{trigger_key}'. Replying to {sender.first_name}.")
-                        await event.reply(content_to_send)
-                        return
-                    elif cmd_type == "media" and content_to_send:
-                        caption = command_details.get("caption", "")
-                        print(f"DEBUG: Found custom media command trigger '{trigger_key}'. Replying with media to {sender.first_name}.")
-                        try:
-                            await client.send_file(event.chat_id, content_to_send, caption=caption, reply_to=event.id)
-                            return
-                        except (PhotoInvalidError, DocumentInvalidError, RPCError) as e:
-                            print(f"Error sending media for command '{trigger_key}' (ID/Hash/Ref invalid?): {e}")
-                            await event.reply(f"Sorry, I had an issue sending the media for that command ({e}). The media might be expired or invalid. Please notify my owner.")
-                            return
-                        except Exception as e:
-                            print(f"General error sending media for command '{trigger_key}': {e}")
-                            await event.reply(f"Sorry, a general error occurred while sending the media for that command ({e}). Please notify my owner.")
-                            return
-
-        # --- General Help Command (for non-owners) ---
-        if not is_owner and event.raw_text.lower() == "/help":
-            help_message = """
-Hi! I'm an auto-reply bot.
+    # --- General Help Command (for non-owners) ---
+    if is_help:
+        await event.reply(PUBLIC_HELP_MESSAGE)
+        return
 
-If I'm online, I can respond to specific keywords:
-- Type `/list_commands` to see currently available custom commands.
 
-If I'm offline, I'll send an automatic reply.
-"""
-            await event.reply(help_message)
-            return
+# --- Bot Startup ---
+@app.on_event("startup")
+async def startup():
+    # A second run would start another client loop, notifier and flusher and register the handlers
+    # again; set the flag before the first await so overlapping calls are caught too
+    global bot_started
+    if bot_started:
+        return
+    bot_started = True
 
-    asyncio.create_task(client.run_until_disconnected())
+    print("Loading bot state and starting Telegram client...")
+    # File reads run in worker threads while the client connects
+    await asyncio.gather(
+        asyncio.to_thread(load_state),
+        asyncio.to_thread(open_mentions_log),
+        client.start(),
+    )
+    print("Telegram client started.")
+    if SESSION_FILE and isinstance(client.session, StringSession):
+        save_session_file()
+
+    # Resolve the notification target once instead of on every forwarded message
+    global target_peer
+    try:
+        target_peer = await client.get_input_entity(TARGET_CHAT_ID)
+    except (ValueError, RPCError) as e:
+        print(f"Warning: Could not resolve TARGET_CHAT_ID {TARGET_CHAT_ID}: {e}. It will be resolved per message.")
+
+    # Registered only now, so no update is handled before the state is loaded.
+    # Telethon filters on the sender id, so each handler only sees its own side of the traffic.
+    client.add_event_handler(handle_owner_message, events.NewMessage(from_users=OWNER_ID))
+    client.add_event_handler(handle_message, events.NewMessage(func=lambda e: e.sender_id != OWNER_ID))
+
+    # Keep a reference so the task isn't garbage-collected while the client runs
+    global client_task, notify_task, state_flush_task
+    client_task = asyncio.create_task(client.run_until_disconnected())
+    notify_task = asyncio.create_task(notify_worker())
+    state_flush_task = asyncio.create_task(state_flusher())
+    schedule_offline_expiry() # A timed offline mode restored from the state file
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if notify_task:
+        notify_task.cancel()
+    if state_flush_task:
+        state_flush_task.cancel()
+    if offline_expiry_task:
+        offline_expiry_task.cancel()
+    if state_dirty.is_set():
+        await flush_state() # Don't lose changes still waiting for the debounce window
+    print("Disconnecting Telegram client...")
+    await client.disconnect()
+    if client_task:
+        await client_task
+    if mentions_log_fh:
+        mentions_log_fh.close()
+    print("Telegram client disconnected.")
 
 # FastAPI endpoints (for Render) - remain mostly unchanged
 @app.get("/")
 async def root():
-    status_msg = "Online" if not is_offline else "Offline"
-    if is_offline and offline_until_timestamp:
-        status_msg += f" (until {offline_until_timestamp.strftime('%Y-%m-%d %H:%M:%S')})"
-    return {"status": status_msg, "offline_mode": is_offline}
+    state = offline_state
+    status_msg = "Online" if not state.offline else "Offline"
+    if state.offline and state.until:
+        status_msg += f" (until {state.until.strftime('%Y-%m-%d %H:%M:%S')})"
+    return {"status": status_msg, "offline_mode": state.offline}
 
 @app.head("/")
 async def head_root():
     return {"status": "Online"}
 
+class OfflineRequest(BaseModel):
+    message: str = "I'm currently offline."
+
 @app.post("/offline")
-async def go_offline_api(data: dict):
-    global is_offline, offline_message, offline_until_timestamp
-    offline_message = data.get("message", "I'm currently offline.")
-    is_offline = True
-    offline_until_timestamp = None
+async def go_offline_api(data: OfflineRequest):
+    global offline_state
+    offline_state = OfflineState(offline=True, message=data.message)
+    schedule_offline_expiry()
     save_state()
-    return {"status": "Offline", "message": offline_message}
+    return {"status": "Offline", "message": offline_state.message}
 
 @app.post("/online")
 async def go_online_api():
-    global is_offline, offline_until_timestamp
-    is_offline = False
-    offline_until_timestamp = None
+    global offline_state
+    offline_state = replace(offline_state, offline=False, until=None)
+    schedule_offline_expiry()
     save_state()
     return {"status": "Online mode enabled"}